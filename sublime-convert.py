@@ -15,7 +15,17 @@
     Tested on Python 3.6.8
 
     USAGE:
-        python sublime-converter.py [.tmTheme file] [output file]
+        python sublime-converter.py [.tmTheme file] [output file] [--safe]
+        python sublime-converter.py [input directory] [output directory] [--safe]
+
+        Given a directory, every .tmTheme file within it is converted in
+        parallel. The output directory defaults to the input directory.
+
+        Running with "python -O" skips the rescue of dicts that have more
+        values than keys, which only happens with malformed themes.
+
+        --safe  Serialize the theme with a JSON library instead of the
+                built-in emitter.
 
 
     License: MIT
@@ -41,9 +51,55 @@
     THE SOFTWARE.
 """
 
-from json import dumps
-from sys  import argv, stderr
-from xml.etree.ElementTree import fromstring
+import os
+import re
+
+from concurrent.futures import ProcessPoolExecutor
+from functools          import lru_cache
+from itertools          import repeat
+from json.encoder       import encode_basestring_ascii
+from os.path            import isdir
+from pathlib            import Path
+from sys                import argv, stderr
+
+try:
+    from lxml.etree import XMLParser, XPath, iterwalk
+    from lxml.etree import fromstring as _fromstring
+    _HAVE_LXML = True
+
+    # ElementTree drops comments and processing instructions, lxml keeps them
+    # as children by default. Drop them here too so both build the same tree.
+    _PARSER = XMLParser(remove_comments=True, remove_pis=True)
+
+    def fromstring(text):
+        return _fromstring(text, _PARSER)
+except ImportError:
+    from xml.etree.ElementTree import fromstring
+    _HAVE_LXML = False
+
+try:
+    from ujson import dumps as _dumps
+
+    def dump(obj, fh, indent):
+        # ujson leaves DEL (U+007F) raw where json escapes it, a raw DEL can
+        # only appear inside a string so it's safe to escape afterwards
+        text = _dumps(obj, indent=indent, escape_forward_slashes=False)
+        fh.write(text.replace("\x7f", "\\u007f"))
+except ImportError:
+    from json import dump
+
+
+_CAMEL_RE = re.compile(r"([A-Z])")
+
+# Child lookups used by walk_theme, precompiled when lxml is available
+if _HAVE_LXML:
+    _dicts = XPath("dict")
+else:
+    def _dicts(element):
+        return element.findall("dict")
+
+# Formatted alpha for every possible hexadecimal alpha byte: _ALPHAS[0xff] = "1.00"
+_ALPHAS = [f"{i / 255:.2f}" for i in range(256)]
 
 
 def parse_theme_info(theme):
@@ -55,18 +111,17 @@ def parse_theme_info(theme):
     theme_info = {}
 
     for dct in theme:
-        keys   = dct.findall("key")
-        values = dct.findall("string")
+        keys, values, _ = _split(dct)
 
         if len(keys) > 0:
             keys = [key for key in keys if key.text != "settings"]
             keys = format_keys(keys)
 
         # Remove UUID
-        for i in range(len(keys) - 1):
-            if keys[i].text == "uuid":
-                keys.pop(i)
-                values.pop(i)
+        pairs  = [(key, value) for key, value in zip(keys, values) if key.text != "uuid"]
+        extra  = values[len(keys):] # Unpaired values, see parse_dict
+        keys   = [key for key, _ in pairs]
+        values = [value for _, value in pairs] + extra
 
         parse_dict(theme_info, keys, values)
 
@@ -81,29 +136,43 @@ def parse_dict(map, keys, values, is_color=False, color_palette=None):
             <dict>...</dict>
         is found.
     """
-    color_id  = None
-    reference = None
+    for key, value in zip(keys, values):
+        if value.text == None: continue
 
-    for key in keys:
-        for value in values:
-            if value.text != None:
-                if is_color and color_palette != None:
-                    color_id  = get_color_id(value.text, color_palette)
-                    color     = value.text
-                    reference = color_palette["references"].get(color)
+        color_id = None
 
-                if reference  != None:
-                    map[key.text] = f"var({reference})"
-                elif color_id != None:
-                    map[key.text] = f"var({color_id})"
-                else:
-                    map[key.text] = value.text.strip()
+        if is_color and color_palette != None:
+            color_id = get_color_id(value.text, color_palette)
 
-            values.remove(value)
-            break
+        if color_id != None:
+            map[key.text] = f"var({color_id})"
+        else:
+            map[key.text] = value.text.strip()
 
-    if len(values) > 0:
-        map[keys[len(keys) - 1].text] = values[len(values) - 1].text
+    # More values than keys (malformed), the last key takes the last value.
+    # Valid themes never get here, so this is skipped under "python -O".
+    if __debug__ and len(values) > len(keys):
+        map[keys[-1].text] = values[-1].text
+
+
+def _split(dct):
+    """
+        Sorts a dict's <key>, <string>, and <dict> children in a single pass.
+    """
+    keys   = []
+    values = []
+    dicts  = []
+
+    for child in dct:
+        tag = child.tag
+        if tag == "key":
+            keys.append(child)
+        elif tag == "string":
+            values.append(child)
+        elif tag == "dict":
+            dicts.append(child)
+
+    return keys, values, dicts
 
 
 def format_keys(keys):
@@ -111,53 +180,102 @@ def format_keys(keys):
         Converts keys like findHighlightForeground to find_highlight_foreground.
     """
     for key in keys:
-        formatted_key = ''.join([f"_{c.lower()}" if c.isupper() else c for c in key.text])
-        key.text      = formatted_key
+        key.text = _to_snake(key.text)
 
     return keys
 
 
-def parse_global_values(theme, color_palette):
+@lru_cache(maxsize=1024)
+def _to_snake(text):
+    return _CAMEL_RE.sub(r"_\1", text).lower()
+
+
+def parse_global_values(global_dicts, color_palette):
     """
         Parses the "globals" table, converts tmTheme keys to the proper format,
         and resolves any color references.
     """
     global_values = {}
 
-    for root in theme:
-        for array in root.findall("array"):
-            for dct in array:
-                if dct[0].text == "settings":
-                    if len(dct) < 2: continue
+    for dct in global_dicts:
+        keys, values, _ = _split(dct[1])
 
-                    keys = dct[1].findall("key")
+        if len(keys) > 0:
+            keys = format_keys(keys)
 
-                    if len(keys) > 0:
-                        keys = format_keys(keys)
+        parse_dict(global_values, keys, values)
 
-                    values = dct[1].findall("string")
+    for key, value in global_values.items():
+        color_id = get_color_id(value, color_palette)
+        if color_id != None:
+            global_values[key] = f"var({color_id})"
 
-                    parse_dict(global_values, keys, values)
-                    array.remove(dct)
+    return global_values
 
-    for key, value in global_values.items():
-        for id, color in color_palette.items():
-            if id == "references": continue
 
-            if value[-1] == "^":
-                reference = color_palette["references"].get(value)
-                if reference != None:
-                    global_values[key] = f"var({reference})"
-            elif value == color:
-                global_values[key] = f"var({id})"
+if _HAVE_LXML:
+    def _entries(theme):
+        """
+            Yields each dict within the top-level "settings" array(s) using a
+            single C-side walk over every <dict>. The root dict sits at depth
+            1, so entries are the depth 2 dicts held by an <array>.
+        """
+        depth = 0
+
+        for event, dct in iterwalk(theme, events=("start", "end"), tag="dict"):
+            if event == "end":
+                depth -= 1
+                continue
+
+            depth += 1
+            if depth == 2 and dct.getparent().tag == "array":
+                yield dct
+else:
+    def _entries(theme):
+        """
+            Yields each dict within the top-level "settings" array(s).
+        """
+        for root in theme:
+            for array in root.findall("array"):
+                yield from array
+
+
+def walk_theme(theme):
+    """
+        Walks the theme's "settings" array once, splitting the globals dict
+        from the rule dicts and collecting each unique color (in the order
+        it appears) along the way.
+    """
+    colors       = {} # Insertion ordered, used as an ordered set
+    global_dicts = []
+    rule_dicts   = []
 
-    return global_values
+    # Local aliases, these are looked up for every element below
+    dicts      = _dicts
+    add_color  = colors.setdefault
+    add_global = global_dicts.append
+    add_rule   = rule_dicts.append
+
+    for dct in _entries(theme):
+        if dct[0].text == "settings" and len(dct) >= 2:
+            add_global(dct)
+        else:
+            add_rule(dct)
 
+        for entry in dicts(dct):
+            for color in entry:
+                text = color.text
+                if text and text[0] == "#":
+                    add_color(text)
 
-def parse_colors(theme):
+    return colors, global_dicts, rule_dicts
+
+
+def parse_colors(colors):
     """
-        Finds each unique color within a theme, parses it, and resolves any
-        references. Used as the "variables" table in the final theme.
+        Parses each unique color within a theme (the ordered set built by
+        walk_theme) and resolves any references. Used as the "variables"
+        table in the final theme.
 
         If a color explicitly contains an alpha value (rgb(a)), the hexadecimal
         alpha is converted into a float between 0.0 and 1.0, and the definition
@@ -173,83 +291,67 @@ def parse_colors(theme):
 
             #ff00ff00 => color(#ff00ff alpha(0.0))
     """
-    if len(theme) <= 0: return
-
-    colors    = []
-    color_map = {}
-
-    # Yikes...
-    for array in theme[0].findall("array"):
-        for dct in array:
-            for entry in dct.findall("dict"):
-                for color in entry:
-                    if color.text != None and color.text.startswith("#"):
-                        if len(color.text) > 7:
-                            color.text += "^"
-
-                        if not color.text in colors:
-                            colors.append(color.text)
-
-    # Create initial color map: ["colorXX"] = "#001122", ["colorXY"] = "#00112233^" (has alpha)
-    for i in range(len(colors)):
-        color = colors[i]
-        color_map[f"color{i:02d}"] = color
-
-    # Create reference lookup table: ["#00112233^"] = "colorXY"
-    references = {}
-    for id, color in color_map.items():
-        if color[-1] == "^":
-            color_hex = color[:-3]
-            alpha     = int(color[-3:-1], 16) / 255
-            reference = get_color_id(color_hex, color_map)
+    # Parallel ids and definitions: ids[i] = "colorXX", definitions[i] = "#001122"
+    ids         = [f"color{i:02d}" for i in range(len(colors))]
+    definitions = []
+
+    # Create reverse lookup table: ["#001122"] = "colorXX", ["#00112233"] = "colorXY"
+    by_value = dict(zip(colors, ids))
+
+    for id, color in zip(ids, colors):
+        definition = color
+
+        # Has alpha: ["#00112233"] => "#001122", "0.20"
+        if len(color) > 7:
+            color_hex = color[:-2]
+            alpha     = _ALPHAS[int(color[-2:], 16)]
+            reference = by_value.get(color_hex)
 
             if reference != None:
-                color_map[id] = f"color(var({reference}) alpha({alpha:.2f}))"
+                definition = f"color(var({reference}) alpha({alpha}))"
             else:
-                color_map[id] = f"color({color_hex} alpha({alpha:.2f}))"
+                definition = f"color({color_hex} alpha({alpha}))"
 
-            references[color] = id
+        definitions.append(definition)
 
-    color_map.update({"references": references})
+    color_map = dict(zip(ids, definitions))
+    color_map.update({"_by_value": by_value})
     return color_map
 
 
 def get_color_id(value, color_palette):
-    for id, color in color_palette.items():
-        if value == color:
-            return id
+    return color_palette["_by_value"].get(value)
 
 
-def parse_rules(theme, color_palette):
+def parse_rules(rule_dicts, color_palette):
     rules = []
 
-    for root in theme:
-        for array in root.findall("array"):
-            for dct in array:
-                keys     = dct.findall("key")
-                values   = dct.findall("string")
-                rule_map = {}
+    for dct in rule_dicts:
+        keys, values, settings = _split(dct)
+        rule_map = {}
 
-                if keys[-1].text == "settings":
-                    keys.pop()
+        if keys[-1].text == "settings":
+            keys.pop()
 
-                parse_dict(rule_map, keys, values)
+        parse_dict(rule_map, keys, values)
 
-                for setting in dct.findall("dict"):
-                    keys = setting.findall("key")
+        for setting in settings:
+            keys, values, _ = _split(setting)
 
-                    if len(keys) > 0:
-                        keys = format_keys(keys)
+            if len(keys) > 0:
+                keys = format_keys(keys)
+            parse_dict(rule_map, keys, values, True, color_palette)
 
-                    values = setting.findall("string")
-                    parse_dict(rule_map, keys, values, True, color_palette)
-
-                rules.append(rule_map)
+        rules.append(rule_map)
 
     return rules
 
 
-def make_theme(info, global_values, color_palette, rules):
+def write_theme(fh, info, global_values, color_palette, rules, safe=False):
+    """
+        Streams the header and the final theme into fh, one section at a
+        time, instead of building the whole document as a string first.
+    """
     formatted_map = info
     formatted_map.update({
         "variables" : color_palette,
@@ -257,9 +359,67 @@ def make_theme(info, global_values, color_palette, rules):
         "rules"     : rules
     })
 
-    json_string = dumps(formatted_map, indent=4) # json.dumps
+    fh.write(generate_header())
+
+    if safe:
+        dump(formatted_map, fh, indent=4) # ujson.dump or json.dump
+    else:
+        emit_scheme(formatted_map, fh)
+
+
+def emit_scheme(formatted_map, fh):
+    """
+        Writes the final theme as JSON without going through json.dump.
+        A sublime-color-scheme only ever contains strings, flat objects of
+        strings, and the list of rule objects, so each is emitted directly.
+        The output matches json.dump(formatted_map, fh, indent=4) exactly.
+    """
+    if len(formatted_map) <= 0:
+        fh.write("{}")
+        return
+
+    separator = "{\n"
+
+    for key, value in formatted_map.items():
+        fh.write(f"{separator}    {_quote(key)}: ")
+        separator = ",\n"
+
+        if isinstance(value, dict):
+            fh.write(_emit_object(value, 4))
+        elif isinstance(value, list):
+            _emit_rules(value, fh)
+        else:
+            fh.write(_quote(value))
+
+    fh.write("\n}")
+
+
+def _emit_rules(rules, fh):
+    if len(rules) <= 0:
+        fh.write("[]")
+        return
+
+    separator = "[\n"
+
+    for rule in rules:
+        fh.write(f"{separator}        {_emit_object(rule, 8)}")
+        separator = ",\n"
+
+    fh.write("\n    ]")
+
 
-    return json_string
+def _emit_object(obj, indent):
+    if len(obj) <= 0: return "{}"
+
+    pad   = " " * (indent + 4)
+    items = ",\n".join(f"{pad}{_quote(key)}: {_quote(value)}" for key, value in obj.items())
+    return "{\n" + items + "\n" + " " * indent + "}"
+
+
+def _quote(value):
+    if value == None: return "null"
+
+    return encode_basestring_ascii(value)
 
 
 def generate_header():
@@ -279,51 +439,120 @@ def generate_header():
 
 
 def error(str):
-    print(f"Error: {str}", file=stderr) # sys.stderr
+    report_error(str)
     exit(1)
 
 
-def main(args):
-    if len(args) < 3:
-        print(f"Usage: {argv[0]} [input] [output]")
-        exit(0)
-
-    input_file  = args[1]
-    output_file = args[2]
-
-    if not input_file.lower().endswith('.tmtheme'):
-        filename = input_file.split('.')
-        error(f"Expected a 'tmtheme' file, was given '{filename[len(filename) - 1]}'")
+def report_error(str):
+    print(f"Error: {str}", file=stderr) # sys.stderr
 
-    if not output_file.lower().endswith('.sublime-color-scheme'):
-        output_file += '.sublime-color-scheme'
 
+def convert(input_file, output_file, safe=False):
     try:
-        with open(input_file, "r") as fh:
-            theme_file = fh.read()
-
-        parsed = fromstring(theme_file) # xml.etree.ElementTree.fromstring
+        # Read as bytes so the parser can honor the declared encoding (lxml
+        # refuses str input that carries an encoding declaration).
+        parsed = fromstring(Path(input_file).read_bytes()) # lxml.etree or xml.etree.ElementTree
     except:
         error(f"Unable to parse file '{input_file}'! Is it valid?")
 
     theme_info      = parse_theme_info(parsed)
-    color_palette   = parse_colors(parsed)
-    global_values   = parse_global_values(parsed, color_palette)
-    rules           = parse_rules(parsed, color_palette)
+    colors, global_dicts, rule_dicts = walk_theme(parsed)
 
-    color_palette.pop("references")
+    color_palette   = parse_colors(colors)
+    global_values   = parse_global_values(global_dicts, color_palette)
+    rules           = parse_rules(rule_dicts, color_palette)
 
-    converted_theme = make_theme(theme_info, global_values, color_palette, rules)
+    color_palette.pop("_by_value")
 
     try:
-        with open(output_file, "w+") as fh:
-            fh.write(generate_header())
-            fh.write(converted_theme)
-    except:
+        # O_BINARY (Windows only) keeps the descriptor from translating newlines
+        # a second time, fdopen's text layer already does that
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+        fd    = os.open(output_file, flags, 0o644)
+    except OSError:
         error(f"Unable to create file '{output_file}'! Do you have the right permissions?")
 
+    try:
+        # A large buffer keeps a typical theme to a single write() call
+        with os.fdopen(fd, "w", encoding="utf-8", buffering=1 << 20) as fh:
+            write_theme(fh, theme_info, global_values, color_palette, rules, safe)
+    except BaseException as e:
+        # Don't leave a truncated theme behind
+        try:
+            os.unlink(output_file)
+        except OSError:
+            pass
+
+        if isinstance(e, OSError):
+            error(f"Unable to write file '{output_file}'! ({e})")
+
+        raise
+
     print(f"Successfully converted '{input_file}' to '{output_file}'")
 
 
+def _convert_one(input_file, output_file, safe):
+    try:
+        convert(input_file, output_file, safe)
+    except SystemExit: # error() has already reported the problem
+        return False
+    except Exception as e:
+        report_error(f"Unable to convert '{input_file}'! ({type(e).__name__}: {e})")
+        return False
+
+    return True
+
+
+def convert_batch(input_dir, output_dir, safe=False):
+    """
+        Converts every .tmTheme file within input_dir, writing each result to
+        output_dir under the same name. Themes are converted in parallel, one
+        per process.
+    """
+    input_files  = sorted(path for path in Path(input_dir).iterdir() if path.name.lower().endswith('.tmtheme'))
+    output_files = [str(Path(output_dir, path.stem + '.sublime-color-scheme')) for path in input_files]
+    input_files  = [str(path) for path in input_files]
+
+    if len(input_files) <= 0:
+        error(f"No 'tmtheme' files found in '{input_dir}'")
+
+    with ProcessPoolExecutor() as executor:
+        results = list(executor.map(_convert_one, input_files, output_files, repeat(safe)))
+
+    if not all(results):
+        exit(1)
+
+
+def main(args):
+    safe = "--safe" in args
+    args = [arg for arg in args if arg != "--safe"]
+
+    if len(args) < 2 or (len(args) < 3 and not isdir(args[1])):
+        print(f"Usage: {argv[0]} [input] [output] [--safe]")
+        print(f"       {argv[0]} [input directory] [output directory] [--safe]")
+        exit(0)
+
+    if isdir(args[1]):
+        output_dir = args[2] if len(args) > 2 else args[1]
+
+        if not isdir(output_dir):
+            error(f"Expected a directory to write themes to, was given '{output_dir}'")
+
+        convert_batch(args[1], output_dir, safe)
+        return
+
+    input_file  = args[1]
+    output_file = args[2]
+
+    if not input_file.lower().endswith('.tmtheme'):
+        filename = input_file.split('.')
+        error(f"Expected a 'tmtheme' file, was given '{filename[len(filename) - 1]}'")
+
+    if not output_file.lower().endswith('.sublime-color-scheme'):
+        output_file += '.sublime-color-scheme'
+
+    convert(input_file, output_file, safe)
+
+
 if __name__ == "__main__":
     main(argv) # sys.argv